@@ -7,47 +7,111 @@ and generates podcast audio using Google's Gemini TTS API.
 """
 
 import base64
+import functools
+import hashlib
 import mimetypes
 import os
+import queue
 import re
+import secrets
 import struct
-from flask import Flask, request, jsonify, send_file
+import threading
+import time
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context
 from google import genai
 from google.genai import types
 import tempfile
-import uuid
 
 app = Flask(__name__)
 
+# http://soundfile.sapp.org/doc/WaveFormat/
+WAV_HEADER_STRUCT = struct.Struct("<4sI4s4sIHHIIHH4sI")
+# Data size advertised while the total length is still unknown
+WAV_STREAM_DATA_SIZE = 0xFFFFFFFF - 36
+
+# Both match only at the start of a ";"-separated parameter, so e.g.
+# "bitrate=" is not taken for the sample rate; only "rate=" ignores case
+_MIME_RE = re.compile(r"(?:^|;)\s*(?:audio/L(\d+)|(?i:rate)=(\d+))")
+_HAS_DAVID = re.compile(r"david:", re.IGNORECASE).search
+_HAS_JANIS = re.compile(r"janis:", re.IGNORECASE).search
+
+MODEL = "gemini-2.5-flash-preview-tts"
+SPEAKER_VOICES = {"david": "Zephyr", "janis": "Puck"}
+TTS_PROMPT = "Read aloud in a warm, welcoming tone:\n"
+
+# Anything that changes the generated audio for a given script must be part
+# of the cache key, otherwise stale audio would be served.
+VOICE_CONFIG_FINGERPRINT = repr((MODEL, TTS_PROMPT, sorted(SPEAKER_VOICES.items()))).encode("utf-8")
+
+# Generated podcasts are cached on disk by script hash; 0 disables the cache.
+# The default lives under the user's home rather than the shared temp dir,
+# where another user could pre-create it and plant audio for known scripts.
+CACHE_DIR = os.environ.get("PODCAST_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "podcast-generator")
+CACHE_SIZE = int(os.environ.get("PODCAST_CACHE_SIZE", 32))
+# A .part file older than gunicorn's --timeout belongs to a worker that was
+# killed mid-generation and will never be finished or cleaned up
+CACHE_PART_MAX_AGE = 1800
+
+# Audio chunks buffered between the TTS stream and a slower HTTP client
+STREAM_BUFFER_CHUNKS = 32
+
+# The client and TTS config are shared across requests so the HTTP
+# connection pool is reused; requests fail with a clear error without a key
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+_CLIENT = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
+
+_TTS_CONFIG = types.GenerateContentConfig(
+    temperature=1,
+    response_modalities=["audio"],
+    speech_config=types.SpeechConfig(
+        multi_speaker_voice_config=types.MultiSpeakerVoiceConfig(
+            speaker_voice_configs=[
+                types.SpeakerVoiceConfig(
+                    speaker=speaker,
+                    voice_config=types.VoiceConfig(
+                        prebuilt_voice_config=types.PrebuiltVoiceConfig(
+                            voice_name=voice_name
+                        )
+                    ),
+                )
+                for speaker, voice_name in SPEAKER_VOICES.items()
+            ]
+        ),
+    ),
+)
+
+def _quiet_unlink(path: str):
+    """Removes a file, ignoring it already being gone or undeletable"""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
 def save_binary_file(file_name, data):
     """Save binary data to file"""
     with open(file_name, "wb") as f:
         f.write(data)
     print(f"File saved to: {file_name}")
 
-def convert_to_wav(audio_data: bytes, mime_type: str) -> bytes:
-    """Generates a WAV file header for the given audio data and parameters.
+def build_wav_header(sample_rate: int, bits_per_sample: int, data_size: int) -> bytes:
+    """Packs a mono PCM WAV header.
 
     Args:
-        audio_data: The raw audio data as a bytes object.
-        mime_type: Mime type of the audio data.
+        sample_rate: Samples per second.
+        bits_per_sample: Bits per sample, e.g. 16.
+        data_size: Size of the PCM data that follows the header, in bytes.
 
     Returns:
-        A bytes object representing the WAV file header.
+        The 44 byte header.
     """
-    parameters = parse_audio_mime_type(mime_type)
-    bits_per_sample = parameters["bits_per_sample"]
-    sample_rate = parameters["rate"]
     num_channels = 1
-    data_size = len(audio_data)
     bytes_per_sample = bits_per_sample // 8
     block_align = num_channels * bytes_per_sample
     byte_rate = sample_rate * block_align
     chunk_size = 36 + data_size  # 36 bytes for header fields before data chunk size
 
-    # http://soundfile.sapp.org/doc/WaveFormat/
-    header = struct.pack(
-        "<4sI4s4sIHHIIHH4sI",
+    return WAV_HEADER_STRUCT.pack(
         b"RIFF",          # ChunkID
         chunk_size,       # ChunkSize (total file size - 8 bytes)
         b"WAVE",          # Format
@@ -62,13 +126,25 @@ def convert_to_wav(audio_data: bytes, mime_type: str) -> bytes:
         b"data",          # Subchunk2ID
         data_size         # Subchunk2Size (size of audio data)
     )
-    return header + audio_data
 
+def resize_wav_header(header: bytes, data_size: int) -> bytes:
+    """Returns a copy of a WAV header with its sizes set for data_size bytes"""
+    fields = list(WAV_HEADER_STRUCT.unpack(header))
+    fields[1] = 36 + data_size  # ChunkSize
+    fields[-1] = data_size      # Subchunk2Size
+    return WAV_HEADER_STRUCT.pack(*fields)
+
+_guess_extension = functools.lru_cache(maxsize=16)(mimetypes.guess_extension)
+
+@functools.lru_cache(maxsize=32)
 def parse_audio_mime_type(mime_type: str) -> dict[str, int | None]:
     """Parses bits per sample and rate from an audio MIME type string.
 
     Assumes bits per sample is encoded like "L16" and rate as "rate=xxxxx".
 
+    Results are memoized since every chunk of a stream shares a mime type,
+    so callers must not mutate the returned dictionary.
+
     Args:
         mime_type: The audio MIME type string (e.g., "audio/L16;rate=24000").
 
@@ -79,117 +155,240 @@ def parse_audio_mime_type(mime_type: str) -> dict[str, int | None]:
     bits_per_sample = 16
     rate = 24000
 
-    # Extract rate from parameters
-    parts = mime_type.split(";")
-    for param in parts: # Skip the main type part
-        param = param.strip()
-        if param.lower().startswith("rate="):
-            try:
-                rate_str = param.split("=", 1)[1]
-                rate = int(rate_str)
-            except (ValueError, IndexError):
-                # Handle cases like "rate=" with no value or non-integer value
-                pass # Keep rate as default
-        elif param.startswith("audio/L"):
-            try:
-                bits_per_sample = int(param.split("L", 1)[1])
-            except (ValueError, IndexError):
-                pass # Keep bits_per_sample as default if conversion fails
+    # One regex pass instead of splitting each parameter
+    for match in _MIME_RE.finditer(mime_type):
+        if match.group(1):
+            bits_per_sample = int(match.group(1))
+        elif match.group(2):
+            rate = int(match.group(2))
 
     return {"bits_per_sample": bits_per_sample, "rate": rate}
 
-def generate_podcast_audio(script_text: str):
-    """Generate podcast audio from script text"""
+def iter_audio_chunks(script_text: str):
+    """Yields (data, mime_type) for each audio chunk Gemini TTS streams back"""
     
     # Validate API key
-    api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
+    if _CLIENT is None:
         raise ValueError("GEMINI_API_KEY environment variable is required")
     
-    client = genai.Client(api_key=api_key)
-    
-    model = "gemini-2.5-flash-preview-tts"
     contents = [
         types.Content(
             role="user",
             parts=[
-                types.Part.from_text(text=f"Read aloud in a warm, welcoming tone:\n{script_text}"),
+                types.Part.from_text(text=f"{TTS_PROMPT}{script_text}"),
             ],
         ),
     ]
     
-    generate_content_config = types.GenerateContentConfig(
-        temperature=1,
-        response_modalities=["audio"],
-        speech_config=types.SpeechConfig(
-            multi_speaker_voice_config=types.MultiSpeakerVoiceConfig(
-                speaker_voice_configs=[
-                    types.SpeakerVoiceConfig(
-                        speaker="david",
-                        voice_config=types.VoiceConfig(
-                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                voice_name="Zephyr"
-                            )
-                        ),
-                    ),
-                    types.SpeakerVoiceConfig(
-                        speaker="janis",
-                        voice_config=types.VoiceConfig(
-                            prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                                voice_name="Puck"
-                            )
-                        ),
-                    ),
-                ]
-            ),
-        ),
-    )
+    has_audio = False
+    
+    for chunk in _CLIENT.models.generate_content_stream(
+        model=MODEL,
+        contents=contents,
+        config=_TTS_CONFIG,
+    ):
+        candidates = chunk.candidates
+        if not candidates:
+            continue
+        content = candidates[0].content
+        if content is None or not content.parts:
+            continue
+        inline_data = content.parts[0].inline_data
+        if not (inline_data and inline_data.data):
+            continue
+        
+        has_audio = True
+        yield inline_data.data, inline_data.mime_type
+    
+    # An empty stream must fail rather than be cached as a 0-byte podcast
+    if not has_audio:
+        raise RuntimeError("Gemini returned no audio")
 
-    # Create temporary file to store audio
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-    temp_file.close()
+def iter_podcast_audio(script_text: str):
+    """Yields (data, is_header) pairs of podcast audio without storing it.
+
+    When the audio is raw PCM the first piece is a WAV header of unknown
+    length, see resize_wav_header.
+    """
+    needs_wav = None
     
-    audio_data = bytearray()
+    for data_buffer, mime_type in iter_audio_chunks(script_text):
+        if needs_wav is None:
+            # Decided once, since every chunk of a stream shares a mime type
+            needs_wav = _guess_extension(mime_type) is None
+            if needs_wav:
+                parameters = parse_audio_mime_type(mime_type)
+                yield build_wav_header(parameters["rate"], parameters["bits_per_sample"], WAV_STREAM_DATA_SIZE), True
+        yield data_buffer, False
+
+def generate_podcast_audio(script_text: str, output_dir: str | None = None, suffix: str = '.wav', on_chunk=None):
+    """Generate podcast audio from script text
+
+    Args:
+        script_text: The script with david: and janis: speakers.
+        output_dir: Directory to create the audio file in. Defaults to the
+            system temporary directory.
+        suffix: File name suffix for the audio file.
+        on_chunk: Optional callable that receives each piece of audio as it
+            is written, starting with a WAV header of unknown length.
+
+    Returns:
+        Path to the generated WAV file.
+    """
+    
+    # Create temporary file to store audio and keep writing to it rather
+    # than closing and reopening it
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=output_dir)
     
     try:
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            if (
-                chunk.candidates is None
-                or chunk.candidates[0].content is None
-                or chunk.candidates[0].content.parts is None
-            ):
-                continue
-                
-            if (chunk.candidates[0].content.parts[0].inline_data and 
-                chunk.candidates[0].content.parts[0].inline_data.data):
-                
-                inline_data = chunk.candidates[0].content.parts[0].inline_data
-                data_buffer = inline_data.data
-                file_extension = mimetypes.guess_extension(inline_data.mime_type)
-                
-                if file_extension is None:
-                    file_extension = ".wav"
-                    data_buffer = convert_to_wav(inline_data.data, inline_data.mime_type)
-                
-                # Append audio data
-                audio_data.extend(data_buffer)
+        header = None
+        data_size = 0
         
-        # Write all audio data to file
-        with open(temp_file.name, 'wb') as f:
-            f.write(audio_data)
+        for piece, is_header in iter_podcast_audio(script_text):
+            if is_header:
+                header = piece
+            else:
+                data_size += len(piece)
             
+            # Stream audio data straight to disk
+            temp_file.write(piece)
+            if on_chunk:
+                on_chunk(piece)
+        
+        # The header is always the first piece; patch in the real sizes
+        if header is not None:
+            temp_file.seek(0)
+            temp_file.write(resize_wav_header(header, data_size))
+        
+        # close() flushes the buffer and raises if any of it failed to write
+        temp_file.close()
         return temp_file.name
         
     except Exception as e:
         # Clean up temp file on error
-        if os.path.exists(temp_file.name):
-            os.unlink(temp_file.name)
+        temp_file.close()
+        _quiet_unlink(temp_file.name)
         raise e
 
+def cache_key(script_text: str) -> str:
+    """Returns the cache key for a script under the current voice config"""
+    return hashlib.blake2b(script_text.encode("utf-8") + VOICE_CONFIG_FINGERPRINT, digest_size=16).hexdigest()
+
+def cache_path(key: str) -> str:
+    """Returns the on-disk location of a cached podcast"""
+    return os.path.join(CACHE_DIR, f"{key}.wav")
+
+def get_cached_audio(key: str) -> str | None:
+    """Returns the cached podcast path for key, or None on a miss"""
+    path = cache_path(key)
+    try:
+        # Bump mtime so eviction treats the entry as recently used
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+def store_cached_audio(key: str, audio_file_path: str) -> str:
+    """Moves a generated podcast into the cache and evicts old entries"""
+    path = cache_path(key)
+    os.replace(audio_file_path, path)
+    evict_cache()
+    return path
+
+def prepare_cache_dir() -> bool:
+    """Creates CACHE_DIR if needed and reports whether podcasts can be
+    stored in it. The directory must belong to us and not be writable by
+    anyone else. The cache is best effort, so problems are only logged."""
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        st = os.stat(CACHE_DIR)
+    except OSError as e:
+        app.logger.warning("Podcast cache unavailable, streaming without it: %s", e)
+        return False
+    # Cached files are served as-is, so nobody else may be able to add them
+    if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o022):
+        app.logger.warning("Podcast cache unavailable, streaming without it: %s is writable by other users", CACHE_DIR)
+        return False
+    if not os.access(CACHE_DIR, os.W_OK | os.X_OK):
+        app.logger.warning("Podcast cache unavailable, streaming without it: %s is not writable", CACHE_DIR)
+        return False
+    return True
+
+def evict_cache():
+    """Removes least recently used podcasts beyond CACHE_SIZE, along with
+    .part files abandoned by killed workers"""
+    try:
+        entries = list(os.scandir(CACHE_DIR))
+    except OSError:
+        return
+    stale_before = time.time() - CACHE_PART_MAX_AGE
+    podcasts = []
+    for entry in entries:
+        if entry.name.endswith(".wav"):
+            podcasts.append(entry)
+        elif entry.name.endswith(".part") and _entry_mtime(entry) < stale_before:
+            _quiet_unlink(entry.path)
+    if len(podcasts) <= CACHE_SIZE:
+        return
+    podcasts.sort(key=_entry_mtime)
+    for entry in podcasts[:len(podcasts) - CACHE_SIZE]:
+        _quiet_unlink(entry.path)
+
+def _entry_mtime(entry: os.DirEntry) -> float:
+    """Returns an entry's mtime, treating one another worker just evicted as oldest"""
+    try:
+        return entry.stat().st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+# Workers killed mid-generation leave .part files behind; sweep them on start
+if CACHE_SIZE > 0:
+    evict_cache()
+
+class AudioStream:
+    """Bounded buffer between a TTS producer thread and the HTTP response.
+
+    The producer blocks only when the buffer is full and the response only
+    when it is empty, so generation and delivery overlap. Iterating yields
+    audio chunks and re-raises any error the producer finished with.
+    """
+
+    _END = object()
+
+    def __init__(self, maxsize: int = STREAM_BUFFER_CHUNKS):
+        self._queue = queue.Queue(maxsize)
+        self._closed = threading.Event()
+
+    def put(self, data):
+        """Queues data, aborting the producer if the response has gone away"""
+        while not self._closed.is_set():
+            try:
+                self._queue.put(data, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise ConnectionAbortedError("Client disconnected before the podcast finished")
+
+    def finish(self, error: Exception | None = None):
+        """Marks the end of the stream, optionally with the producer's error"""
+        try:
+            self.put(self._END if error is None else error)
+        except ConnectionAbortedError:
+            pass
+
+    def close(self):
+        """Called by the consumer when it stops reading"""
+        self._closed.set()
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
 @app.route('/', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -210,43 +409,82 @@ def generate_podcast():
             return jsonify({"error": "Script cannot be empty"}), 400
         
         # Validate that script contains david: and janis: speakers
-        if 'david:' not in script_text.lower() or 'janis:' not in script_text.lower():
+        if not (_HAS_DAVID(script_text) and _HAS_JANIS(script_text)):
             return jsonify({
                 "error": "Script must contain both 'david:' and 'janis:' speakers"
             }), 400
         
-        # Generate audio
-        audio_file_path = generate_podcast_audio(script_text)
+        key = cache_key(script_text) if CACHE_SIZE > 0 else None
+        cached_path = get_cached_audio(key) if key else None
+        # The cache key already identifies the audio; only uncached
+        # podcasts need a random name
+        download_name = f'podcast_{key[:8] if key else secrets.token_hex(4)}.wav'
+        if cached_path:
+            # Pass the path (not a file object or bytes) so Werkzeug wraps the
+            # file with environ['wsgi.file_wrapper'], which gunicorn/uWSGI serve
+            # with sendfile(2) instead of copying it through Python buffers.
+            return send_file(
+                cached_path,
+                as_attachment=True,
+                download_name=download_name,
+                mimetype='audio/wav'
+            )
+        
+        # Generate audio in the background and stream it as it arrives
+        fill_cache = key is not None and prepare_cache_dir()
+        stream = AudioStream()
         
-        # Send the audio file and clean up after response
-        def remove_file(response):
+        def produce():
+            audio_file_path = None
             try:
-                if os.path.exists(audio_file_path):
-                    os.unlink(audio_file_path)
-            except:
-                pass
-            return response
+                # Fill under a .part name so eviction never sees a half-written file
+                if fill_cache:
+                    audio_file_path = generate_podcast_audio(script_text, output_dir=CACHE_DIR, suffix='.part', on_chunk=stream.put)
+                else:
+                    # Nothing to keep, so skip the file entirely
+                    for piece, _ in iter_podcast_audio(script_text):
+                        stream.put(piece)
+            except Exception as e:
+                stream.finish(e)
+                return
+            stream.finish()
+            
+            # The client already has the audio, so a failure to cache it
+            # must not affect the response
+            if audio_file_path:
+                try:
+                    store_cached_audio(key, audio_file_path)
+                except OSError:
+                    _quiet_unlink(audio_file_path)
         
-        response = send_file(
-            audio_file_path,
-            as_attachment=True,
-            download_name=f'podcast_{uuid.uuid4().hex[:8]}.wav',
-            mimetype='audio/wav'
-        )
+        threading.Thread(target=produce, daemon=True).start()
+        
+        # Wait for the first chunk so setup failures still get a JSON error
+        chunks = iter(stream)
+        first_chunk = next(chunks, b"")
+        
+        def generate():
+            try:
+                yield first_chunk
+                yield from chunks
+            finally:
+                stream.close()
         
-        # Register cleanup callback
-        response.call_on_close(lambda: remove_file(response))
-        return response
+        # No Content-Length, so the body goes out with chunked transfer
+        # encoding; ask nginx-style proxies not to buffer it either
+        return Response(
+            stream_with_context(generate()),
+            mimetype='audio/wav',
+            headers={
+                'Content-Disposition': f'attachment; filename={download_name}',
+                'X-Accel-Buffering': 'no'
+            },
+            direct_passthrough=True
+        )
         
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
-        # Clean up temp file on error
-        if 'audio_file_path' in locals() and os.path.exists(audio_file_path):
-            try:
-                os.unlink(audio_file_path)
-            except:
-                pass
         return jsonify({"error": f"Failed to generate podcast: {str(e)}"}), 500
 
 @app.route('/example', methods=['GET'])
@@ -263,5 +501,6 @@ janis: Well, I think we should start with the basics of our service and how it w
     })
 
 if __name__ == '__main__':
+    # Development server only; production runs under gunicorn (see Dockerfile)
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)